@@ -10,45 +10,81 @@ launches and would fail to detect background apps or special surfaces.
 Therefore it's recommended to supplement the script with use of systemd user
 services for such background apps.
 
-Dependencies: dbus-next, i3ipc, psutil, tenacity, python-xlib
+The scan for child processes is skipped for apps that were repeatedly observed
+to run as a single process, and repeated periodically. SIGHUP makes the script
+forget these observations instead of terminating it.
+
+Dependencies: dbus-next, i3ipc, psutil, python-xlib or xcffib
 """
 import argparse
 import asyncio
 import logging
+import os
 import re
+import signal
 import socket
 import struct
 import sys
+from collections import deque
 from functools import lru_cache
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple, Type
 
-from dbus_next import Variant
+from dbus_next import Message, MessageType, Variant
 from dbus_next.aio import MessageBus
+from dbus_next.constants import ErrorType
 from dbus_next.errors import DBusError
 from i3ipc import Event
 from i3ipc.aio import Con, Connection
-from psutil import Process
-from tenacity import retry, retry_if_exception_type, stop_after_attempt
 
 if sys.version_info[:2] >= (3, 9):
     from collections.abc import Callable
 else:
     from typing import Callable
 
+if TYPE_CHECKING:
+    from psutil import Process
+
 
 LOG = logging.getLogger("assign-cgroups")
 SD_BUS_NAME = "org.freedesktop.systemd1"
 SD_OBJECT_PATH = "/org/freedesktop/systemd1"
+SD_MANAGER_INTERFACE = "org.freedesktop.systemd1.Manager"
 SD_SLICE_FORMAT = "app-{app_id}.slice"
 SD_UNIT_FORMAT = "app-{app_id}-{unique}.scope"
 # Ids of known launcher applications that are not special surfaces. When the app is
 # started using one of those, it should be moved to a new cgroup.
 # Launcher should only be listed here if it creates cgroup of its own.
 LAUNCHER_APPS = ["nwgbar", "nwgdmenu", "nwggrid", "onagre"]
+# Number of processes remembered as already moved to a scope.
+SCOPED_PROCS_CACHE_SIZE = 256
+# Window events arriving within BATCH_DELAY seconds of each other are coalesced,
+# and windows of the same app are assigned to a single scope with one DBus call.
+BATCH_DELAY = 0.02
+BATCH_MAX_SIZE = 8
+# StartTransientUnit attempts and initial delay between them, doubled each time
+SD_CALL_ATTEMPTS = 3
+SD_CALL_RETRY_DELAY = 0.01
+# Consecutive launches without child processes after which an app is assumed to
+# run as a single process, and number of launches the child process scan is
+# skipped for before checking again.
+NO_CHILDREN_THRESHOLD = 3
+NO_CHILDREN_SKIP_LIMIT = 16
+
+# cgroup v2 hierarchy mount points for unified and hybrid layouts
+CGROUP_MOUNTPOINTS = ["/sys/fs/cgroup", "/sys/fs/cgroup/unified"]
 
 SD_UNIT_ESCAPE_RE = re.compile(r"[^\w:.\\]", re.ASCII)
+# Escaped representation of each byte value
+SD_UNIT_ESCAPE_TABLE = [
+    f"\\x{x:02x}" if SD_UNIT_ESCAPE_RE.match(chr(x)) else chr(x) for x in range(256)
+]
+# struct ucred returned by SO_PEERCRED
+UCRED_STRUCT = struct.Struct("iII")
+# Default Sway IPC socket path: $XDG_RUNTIME_DIR/sway-ipc.$UID.$PID.sock
+SWAY_SOCKET_PID_RE = re.compile(r"/sway-ipc\.\d+\.(\d+)\.sock$")
 
 
+@lru_cache(maxsize=256)
 def escape_app_id(app_id: str) -> str:
     """Escape app_id for systemd APIs.
 
@@ -58,16 +94,43 @@ def escape_app_id(app_id: str) -> str:
 
     We also want to escape "-" to avoid creating extra slices.
     """
+    if SD_UNIT_ESCAPE_RE.search(app_id) is None:
+        return app_id
+    return "".join([SD_UNIT_ESCAPE_TABLE[x] for x in app_id.encode()])
 
-    def repl(match):
-        return "".join([f"\\x{x:02x}" for x in match.group().encode()])
 
-    return SD_UNIT_ESCAPE_RE.sub(repl, app_id)
+@lru_cache(maxsize=256)
+def slice_for(app_id: str) -> str:
+    """Get slice name for the escaped app_id"""
+    return SD_SLICE_FORMAT.format(app_id=app_id)
 
 
-LAUNCHER_APP_CGROUPS = [
-    SD_SLICE_FORMAT.format(app_id=escape_app_id(app)) for app in LAUNCHER_APPS
-]
+LAUNCHER_APP_CGROUPS_RE = re.compile(
+    "|".join(re.escape(slice_for(escape_app_id(app))) for app in LAUNCHER_APPS)
+)
+
+
+# Reusable buffer for /proc/<pid>/cgroup and /proc/<pid>/stat reads. The cgroup
+# file is a single `0::<path>` line on the unified hierarchy, so PATH_MAX is
+# enough for both in the common case. Larger files are read in full.
+_PROC_BUF = bytearray(4096)
+
+
+def read_proc_file(path: str) -> Tuple[bytearray, int]:
+    """Read a /proc file, preferably into the shared buffer; return data and size"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.readv(fd, [_PROC_BUF])
+    finally:
+        os.close(fd)
+    if size < len(_PROC_BUF):
+        return _PROC_BUF, size
+    # The buffer is full, so the data may be truncated. Read the whole file again
+    # instead of continuing, as /proc files are generated on each read.
+    LOG.debug("%s does not fit in the buffer", path)
+    with open(path, "rb") as file:
+        data = bytearray(file.read())
+    return data, len(data)
 
 
 def get_cgroup(pid: int) -> Optional[str]:
@@ -76,14 +139,103 @@ def get_cgroup(pid: int) -> Optional[str]:
     Assumes cgroups v2 unified hierarchy.
     """
     try:
-        with open(f"/proc/{pid}/cgroup", "r") as file:
-            cgroup = file.read()
-        return cgroup.strip().split(":")[-1]
+        buf, size = read_proc_file(f"/proc/{pid}/cgroup")
     except OSError:
         LOG.exception("Error geting cgroup info")
+        return None
+
+    # `hierarchy-ID:controller-list:cgroup-path`, with the unified hierarchy
+    # entry (`0::`) being the last or the only line.
+    end = size - 1 if size > 0 and buf[size - 1] == 0x0A else size
+    start = buf.rfind(b"\n", 0, end) + 1
+    start = buf.find(b":", buf.find(b":", start, end) + 1, end) + 1
+    return buf[start:end].decode()
+
+
+def get_cgroup_procs(cgroup: str) -> Optional[Set[int]]:
+    """
+    Get PIDs of all processes in the cgroup.
+    Returns None if the cgroup v2 hierarchy is not available.
+    """
+    for mountpoint in CGROUP_MOUNTPOINTS:
+        try:
+            with open(f"{mountpoint}{cgroup}/cgroup.procs", "rb") as file:
+                return {int(pid) for pid in file.read().split()}
+        except OSError:
+            continue
     return None
 
 
+def scan_children() -> Dict[int, List[int]]:
+    """
+    Build a map of parent PID to child PIDs for all processes.
+    Reads /proc/<pid>/stat of each process only once, unlike psutil's
+    Process.children(), and does not create Process objects.
+    """
+    children: Dict[int, List[int]] = {}
+    with os.scandir("/proc") as entries:
+        for entry in entries:
+            name = entry.name
+            if name[0] not in "0123456789":
+                continue
+            try:
+                buf, size = read_proc_file(f"/proc/{name}/stat")
+            except OSError:
+                # the process has already exited
+                continue
+            # `pid (comm) state ppid ...`; comm may contain spaces and parentheses
+            start = buf.rfind(b")", 0, size) + 4
+            ppid = int(buf[start : buf.find(b" ", start, size)])
+            children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+@lru_cache(maxsize=1)
+def get_process_class() -> Type["Process"]:
+    """On-demand import of psutil.Process"""
+    # pylint: disable=import-outside-toplevel
+    # Defer psutil import until the connections are established.
+    from psutil import Process
+
+    return Process
+
+
+class ProcessSnapshot:
+    """
+    Process tree and cgroup members, read on demand and shared by all the
+    windows of a batch.
+    """
+
+    def __init__(self):
+        self._children: Optional[Dict[int, List[int]]] = None
+        self._cgroup_procs: Dict[str, Optional[Set[int]]] = {}
+
+    def invalidate(self):
+        """Drop the data read so far, e.g. after some of the processes exited"""
+        self._children = None
+        self._cgroup_procs.clear()
+
+    def descendants(self, pids: Iterable[int]) -> List[int]:
+        """Get all descendants of the processes specified by pids"""
+        if self._children is None:
+            self._children = scan_children()
+        children = self._children
+
+        descendants: List[int] = []
+        queue = deque(pids)
+        while queue:
+            for child in children.get(queue.popleft(), ()):
+                descendants.append(child)
+                queue.append(child)
+        return descendants
+
+    def cgroup_procs(self, cgroup: str) -> Optional[Set[int]]:
+        """Get PIDs of all processes in the cgroup, see get_cgroup_procs"""
+        if cgroup not in self._cgroup_procs:
+            self._cgroup_procs[cgroup] = get_cgroup_procs(cgroup)
+        return self._cgroup_procs[cgroup]
+
+
 def get_pid_by_socket(sockpath: str) -> int:
     """
     getsockopt (..., SO_PEERCRED, ...) returns the following structure
@@ -98,19 +250,94 @@ def get_pid_by_socket(sockpath: str) -> int:
     with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
         sock.connect(sockpath)
         ucred = sock.getsockopt(
-            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("iII")
+            socket.SOL_SOCKET, socket.SO_PEERCRED, UCRED_STRUCT.size
         )
-    pid, _, _ = struct.unpack("iII", ucred)
+    pid, _, _ = UCRED_STRUCT.unpack(ucred)
     return pid
 
 
+def get_compositor_pid(sockpath: str) -> int:
+    """
+    Get compositor PID from the default Sway socket name, falling back to
+    SO_PEERCRED for custom socket paths and other compositors.
+    """
+    match = SWAY_SOCKET_PID_RE.search(sockpath)
+    if match is not None:
+        return int(match.group(1))
+    return get_pid_by_socket(sockpath)
+
+
 def create_x11_pid_getter() -> Callable[[int], int]:
     """Create fallback X11 PID getter.
 
     Sway 1.6.1/wlroots 0.14 can use XRes to get the PID for Xwayland apps from
     the server and won't ever reach that. The fallback is preserved for
     compatibility with i3 and earlier versions of Sway.
+
+    xcffib is preferred when available, as it does the request marshalling and
+    reply parsing in libxcb instead of pure Python.
     """
+    try:
+        return create_xcb_pid_getter()
+    except ImportError:
+        return create_xlib_pid_getter()
+
+
+def create_xcb_pid_getter() -> Callable[[int], int]:
+    """Create X11 PID getter using xcffib"""
+    # pylint: disable=import-outside-toplevel
+    import xcffib
+    import xcffib.res
+    import xcffib.xproto
+
+    conn = xcffib.connect()
+    # Same as conn.core, which mypy can't infer the type of
+    core = xcffib.xproto.xprotoExtension(conn)
+    net_wm_pid = core.InternAtom(False, len("_NET_WM_PID"), "_NET_WM_PID").reply().atom
+    pid_mask = xcffib.res.ClientIdMask.LocalClientPID
+
+    def get_net_wm_pid(wid: int) -> int:
+        """Get PID from _NET_WM_PID property of X11 window"""
+        pid = core.GetProperty(
+            False, wid, net_wm_pid, xcffib.xproto.Atom.CARDINAL, 0, 1
+        ).reply()
+
+        if pid.value_len == 0:
+            raise RuntimeError("Failed to get PID from _NET_WM_PID")
+        return int(pid.value.to_atoms()[0])
+
+    def get_xres_client_id(wid: int) -> int:
+        """Get PID from X server via X-Resource extension"""
+        spec = xcffib.res.ClientIdSpec.synthetic(wid, pid_mask)
+        res = conn(xcffib.res.key).QueryClientIds(1, [spec]).reply()
+        for cid in res.ids:
+            if cid.spec.client > 0 and cid.spec.mask == pid_mask:
+                for value in cid.value:
+                    return value
+        raise RuntimeError("Failed to get PID via X-Resource extension")
+
+    extname = xcffib.res.key.name
+    if not core.QueryExtension(len(extname), extname).reply().present:
+        LOG.warning(
+            "X-Resource extension is not supported. "
+            "Process identification for X11 applications will be less reliable."
+        )
+        return get_net_wm_pid
+
+    ver = conn(xcffib.res.key).QueryVersion(1, 2).reply()
+    LOG.info(
+        "X-Resource version %d.%d",
+        ver.server_major,
+        ver.server_minor,
+    )
+    if (ver.server_major, ver.server_minor) < (1, 2):
+        return get_net_wm_pid
+
+    return get_xres_client_id
+
+
+def create_xlib_pid_getter() -> Callable[[int], int]:
+    """Create X11 PID getter using python-xlib"""
     # pylint: disable=import-outside-toplevel
     # Defer Xlib import until we really need it.
     from Xlib import X
@@ -170,6 +397,14 @@ class CGroupHandler:
     def __init__(self, bus: MessageBus, conn: Connection):
         self._bus = bus
         self._conn = conn
+        # (pid, create_time) -> scope of the processes we have already moved.
+        # The cgroup of these won't change unless someone else migrates them,
+        # so there's no need to read /proc again on subsequent windows.
+        self._scoped_procs: Dict[Tuple[int, float], str] = {}
+        # Escaped app_id -> number of consecutive launches without child processes.
+        # The scan for child processes is skipped once NO_CHILDREN_THRESHOLD is
+        # reached; send SIGHUP to forget all of them.
+        self._no_children_apps: Dict[str, int] = {}
 
     @property
     @lru_cache(maxsize=1)
@@ -185,16 +420,18 @@ class CGroupHandler:
     async def connect(self):
         """asynchronous initialization code"""
         # pylint: disable=attribute-defined-outside-init
-        introspection = await self._bus.introspect(SD_BUS_NAME, SD_OBJECT_PATH)
-        self._sd_proxy = self._bus.get_proxy_object(
-            SD_BUS_NAME, SD_OBJECT_PATH, introspection
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker = asyncio.ensure_future(self._process_queue())
+        # Fail at startup rather than on each window if psutil is missing
+        get_process_class()
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, self._no_children_apps.clear
         )
-        self._sd_manager = self._sd_proxy.get_interface(f"{SD_BUS_NAME}.Manager")
 
-        self._compositor_pid = get_pid_by_socket(self._conn.socket_path)
-        self._compositor_cgroup = get_cgroup(self._compositor_pid)
+        compositor_pid = get_compositor_pid(self._conn.socket_path)
+        self._compositor_cgroup = get_cgroup(compositor_pid)
         assert self._compositor_cgroup is not None
-        LOG.info("compositor:%s %s", self._compositor_pid, self._compositor_cgroup)
+        LOG.info("compositor:%s %s", compositor_pid, self._compositor_cgroup)
 
         self._conn.on(Event.WINDOW_NEW, self._on_new_window)
         return self
@@ -213,44 +450,157 @@ class CGroupHandler:
         """Check criteria for assigning current app into an isolated cgroup"""
         if cgroup is None:
             return False
-        for launcher in LAUNCHER_APP_CGROUPS:
-            if launcher in cgroup:
-                return True
-        return cgroup == self._compositor_cgroup
-
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(DBusError),
-        stop=stop_after_attempt(3),
-    )
-    async def assign_scope(self, app_id: str, proc: Process):
+        if cgroup == self._compositor_cgroup:
+            return True
+        return LAUNCHER_APP_CGROUPS_RE.search(cgroup) is not None
+
+    async def assign_scope(
+        self,
+        app_id: str,
+        procs: List["Process"],
+        cgroups: Set[str],
+        snapshot: ProcessSnapshot,
+    ):
         """
-        Assign process (and all unassigned children) to the
-        app-{app_id}.slice/app{app_id}-{pid}.scope cgroup
+        Assign processes (and all unassigned children) to the
+        app-{app_id}.slice/app{app_id}-{pid}.scope cgroup, where pid is the PID of
+        the first process. cgroups are the current cgroups of the processes.
         """
+        # There's a risk of race as the processes may exit by the time dbus call
+        # reaches systemd, so the whole operation is retried on DBus errors.
+        for attempt in range(SD_CALL_ATTEMPTS):
+            try:
+                await self._assign_scope(app_id, procs, cgroups, snapshot)
+                return
+            except DBusError:
+                if attempt == SD_CALL_ATTEMPTS - 1:
+                    raise
+                # A single exited window process would fail the call for the
+                # whole batch; don't let it take the other windows down with it.
+                procs = [proc for proc in procs if proc.is_running()]
+                if not procs:
+                    LOG.debug("all processes of %s have exited", app_id)
+                    return
+                # The exited process could be one of the children as well
+                snapshot.invalidate()
+                await asyncio.sleep(SD_CALL_RETRY_DELAY * 2**attempt)
+
+    async def _assign_scope(
+        self,
+        app_id: str,
+        procs: List["Process"],
+        cgroups: Set[str],
+        snapshot: ProcessSnapshot,
+    ):
+        """Single attempt of assign_scope"""
+        pids = dict.fromkeys(proc.pid for proc in procs)
         app_id = escape_app_id(app_id)
-        sd_slice = SD_SLICE_FORMAT.format(app_id=app_id)
-        sd_unit = SD_UNIT_FORMAT.format(app_id=app_id, unique=proc.pid)
+        sd_slice = slice_for(app_id)
+        sd_unit = SD_UNIT_FORMAT.format(app_id=app_id, unique=next(iter(pids)))
         # Collect child processes as systemd assigns a scope only to explicitly
         # specified PIDs.
-        # There's a risk of race as the child processes may exit by the time dbus call
-        # reaches systemd, hence the @retry decorator is applied to the method.
-        pids = [proc.pid] + [
-            x.pid
-            for x in proc.children(recursive=True)
-            if self.cgroup_change_needed(get_cgroup(x.pid))
-        ]
-
-        await self._sd_manager.call_start_transient_unit(
-            sd_unit,
-            "fail",
-            [["PIDs", Variant("au", pids)], ["Slice", Variant("s", sd_slice)]],
-            [],
+        count = self._no_children_apps.get(app_id, 0)
+        no_children = count >= NO_CHILDREN_THRESHOLD
+        if not no_children:
+            num_procs = len(pids)
+            self._add_children(pids, cgroups, snapshot)
+            no_children = len(pids) == num_procs
+
+        # Call the method directly, without a proxy object and the introspection
+        # data it requires.
+        reply = await self._bus.call(
+            Message(
+                destination=SD_BUS_NAME,
+                path=SD_OBJECT_PATH,
+                interface=SD_MANAGER_INTERFACE,
+                member="StartTransientUnit",
+                signature="ssa(sv)a(sa(sv))",
+                body=[
+                    sd_unit,
+                    "fail",
+                    [
+                        ["PIDs", Variant("au", list(pids))],
+                        ["Slice", Variant("s", sd_slice)],
+                    ],
+                    [],
+                ],
+            )
         )
+        if reply is None:
+            raise DBusError(ErrorType.NO_REPLY, "No reply to StartTransientUnit")
+        if reply.message_type == MessageType.ERROR:
+            # pylint: disable=protected-access
+            raise DBusError._from_message(reply)
+        for proc in procs:
+            self._remember_scoped(proc, sd_unit)
+        self._update_no_children(app_id, count, no_children)
         LOG.debug(
             "window %s successfully assigned to cgroup %s/%s", app_id, sd_slice, sd_unit
         )
 
+    def _update_no_children(self, app_id: str, count: int, no_children: bool):
+        """Count consecutive launches of the app without child processes"""
+        count += 1
+        if not no_children or count >= NO_CHILDREN_THRESHOLD + NO_CHILDREN_SKIP_LIMIT:
+            # Scan again, the app may have started spawning children
+            self._no_children_apps.pop(app_id, None)
+            return
+        if count == NO_CHILDREN_THRESHOLD:
+            LOG.debug("app %s has no child processes", app_id)
+        self._no_children_apps[app_id] = count
+
+    def _add_children(
+        self, pids: Dict[int, None], cgroups: Set[str], snapshot: ProcessSnapshot
+    ):
+        """Add descendants of the pids that need a cgroup change"""
+        # Children inherit the cgroup of the parent, so reading the member list of
+        # the app cgroups once is enough to find the children that still need to
+        # be moved. Fall back to checking each child if cgroupfs is inaccessible.
+        members: Set[int] = set()
+        use_members = True
+        for cgroup in cgroups:
+            procs_in_cgroup = snapshot.cgroup_procs(cgroup)
+            if procs_in_cgroup is None:
+                use_members = False
+                break
+            members |= procs_in_cgroup
+
+        change_needed = self.cgroup_change_needed
+        for pid in snapshot.descendants(pids):
+            if use_members:
+                if pid in members:
+                    pids[pid] = None
+            elif change_needed(get_cgroup(pid)):
+                pids[pid] = None
+
+    async def _process_queue(self):
+        """Coalesce queued windows and assign them to scopes in batches"""
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(BATCH_DELAY)
+            while len(batch) < BATCH_MAX_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            groups: Dict[str, Tuple[List["Process"], Set[str]]] = {}
+            for app_id, proc, cgroup in batch:
+                procs, cgroups = groups.setdefault(app_id, ([], set()))
+                procs.append(proc)
+                cgroups.add(cgroup)
+
+            snapshot = ProcessSnapshot()
+            for app_id, (procs, cgroups) in groups.items():
+                try:
+                    await self.assign_scope(app_id, procs, cgroups, snapshot)
+                # pylint: disable=broad-except
+                except Exception as exc:
+                    LOG.error("Failed to modify cgroup for %s: %s", app_id, exc)
+
+    def _remember_scoped(self, proc: "Process", sd_unit: str):
+        """Record the process as assigned to a scope, evicting the oldest entry"""
+        if len(self._scoped_procs) >= SCOPED_PROCS_CACHE_SIZE:
+            del self._scoped_procs[next(iter(self._scoped_procs))]
+        self._scoped_procs[(proc.pid, proc.create_time())] = sd_unit
+
     async def _on_new_window(self, _: Connection, event: Event):
         """window:new IPC event handler"""
         con = event.container
@@ -260,14 +610,19 @@ class CGroupHandler:
             if pid is None:
                 LOG.warning("Failed to get pid for %s", app_id)
                 return
-            proc = Process(pid)
-            cgroup = get_cgroup(proc.pid)
+            proc = get_process_class()(pid)
             # some X11 apps don't set WM_CLASS. fallback to process name
             if app_id is None:
                 app_id = proc.name()
-            LOG.debug("window %s(%s) cgroup %s", app_id, proc.pid, cgroup)
+            # create_time is already cached by psutil, so the lookup is free
+            sd_unit = self._scoped_procs.get((pid, proc.create_time()))
+            if sd_unit is not None:
+                LOG.debug("window %s(%s) already in %s", app_id, pid, sd_unit)
+                return
+            cgroup = get_cgroup(pid)
+            LOG.debug("window %s(%s) cgroup %s", app_id, pid, cgroup)
             if self.cgroup_change_needed(cgroup):
-                await self.assign_scope(app_id, proc)
+                self._queue.put_nowait((app_id, proc, cgroup))
         # pylint: disable=broad-except
         except Exception as exc:
             LOG.error("Failed to modify cgroup for %s: %s", app_id, exc)
@@ -276,8 +631,9 @@ class CGroupHandler:
 async def main():
     """Async entrypoint"""
     try:
-        bus = await MessageBus().connect()
-        conn = await Connection(auto_reconnect=False).connect()
+        bus, conn = await asyncio.gather(
+            MessageBus().connect(), Connection(auto_reconnect=False).connect()
+        )
         await CGroupHandler(bus, conn).connect()
         await conn.main()
     except DBusError as exc: